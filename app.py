@@ -1,55 +1,657 @@
 #!/usr/bin/env python3
 
+import mmap
 import os
+import random
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from io import BytesIO
+from itertools import chain
+from urllib.request import Request, urlopen
 
-from flask import Flask, request, json
+from flask import Flask, Response, request, json
 from pocketsphinx import Pocketsphinx
+from werkzeug.serving import make_server
+
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join('/opt', 'data'))
+# Number of decoders for /stt, each one holds its own copy of the model
+DECODERS = int(os.environ.get('DECODERS', 1))
+# Number of decoders and parallel jobs, separate from /stt so long jobs don't block requests
+JOB_DECODERS = int(os.environ.get('JOB_DECODERS', 1))
+# Keep finished jobs for this many hours, 0 - forever
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 168))
+# Extra decoder with tight beams for the early hypothesis, see /stt?fast=1
+FAST_PASS = os.environ.get('FAST_PASS') == '1'
+FAST_CONFIG = {'beam': 1e-20, 'pbeam': 1e-20, 'wbeam': 1e-15, 'maxhmmpf': 3000, 'fwdflat': False, 'bestpath': False}
+# Replace a decoder after it served this many requests to cap memory growth, 0 - never
+RECYCLE_AFTER = int(os.environ.get('RECYCLE_AFTER', 0))
+# How long to wait for in-flight requests and jobs on shutdown, sec
+DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', 30))
+# Directory with files available through /stt?path=, empty - disabled
+LOCAL_DIR = os.environ.get('LOCAL_DIR', '')
+# Allow reading shared memory segments through /stt?shm=
+LOCAL_SHM = os.environ.get('LOCAL_SHM') == '1'
+# Share of /stt requests to capture, 0 - disabled
+CAPTURE_RATE = float(os.environ.get('CAPTURE_RATE', 0))
+# Capture archive size limit, MiB
+CAPTURE_SIZE = int(os.environ.get('CAPTURE_SIZE', 100))
 
 
 class PocketSphinx(Pocketsphinx):
-    def decode_fp(self, fp=None, buffer_size=2048, no_search=False, full_utt=False):
+    def decode_fp(self, fp=None, buffer_size=2048, no_search=False, full_utt=False, head=b''):
         buf = bytearray(buffer_size)
         with self.start_utterance():
-            while fp.readinto(buf):
-                self.process_raw(buf, no_search, full_utt)
+            if head:
+                self.process_raw(head, no_search, full_utt)
+            while True:
+                size = fp.readinto(buf)
+                if not size:
+                    break
+                self.process_raw(buf if size == buffer_size else buf[:size], no_search, full_utt)
+        return self
+
+    def decode_channel(self, samples, channel, channels, block_size=1024):
+        step = block_size * channels
+        with self.start_utterance():
+            for pos in range(channel, len(samples), step):
+                self.process_raw(samples[pos:pos + step:channels].tobytes(), False, False)
         return self
 
 
-def ps_init():
+class DecoderPool:
+    def __init__(self, size, model, recycle=0, **config):
+        self.size = size
+        self._recycle = recycle
+        self._model = model
+        self._config = config
+        self._free = [ps_init(model, **config) for _ in range(size)]
+        self._all = list(self._free)
+        self._uses = {id(decoder): 0 for decoder in self._all}
+        self._cond = threading.Condition()
+        # Only one new model is loaded at a time, so at most one extra copy is kept in memory
+        self._loading = threading.Lock()
+
+    @contextmanager
+    def acquire(self, count=1):
+        count = min(count, self.size)
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._free) >= count)
+            decoders, self._free = self._free[:count], self._free[count:]
+        try:
+            yield decoders
+        finally:
+            with self._cond:
+                self._free.extend(decoders)
+                self._cond.notify_all()
+                for decoder in decoders:
+                    self._uses[id(decoder)] += 1
+                    if self._recycle and self._uses[id(decoder)] == self._recycle:
+                        threading.Thread(target=self._recycle_decoder, args=(decoder,), daemon=True).start()
+
+    def reload(self, model):
+        with self._loading:
+            # A broken model raises here, before the pool switches to it
+            new = ps_init(model, **self._config)
+            with self._cond:
+                # Recycled decoders use the new model from now on too
+                self._model = model
+                old = list(self._all)
+        self._replace(old[0], new)
+        for decoder in old[1:]:
+            self._replace(decoder)
+
+    def _recycle_decoder(self, old):
+        try:
+            self._replace(old)
+        except Exception as e:
+            print('Decoder recycling failed: {}'.format(e))
+            with self._cond:
+                # Retry after the next RECYCLE_AFTER requests
+                if id(old) in self._uses:
+                    self._uses[id(old)] = 0
+
+    def _replace(self, old, new=None):
+        # The new decoder is ready before the old one retires, capacity never drops
+        with self._loading:
+            with self._cond:
+                if old not in self._all:
+                    return
+            if new is None:
+                new = ps_init(self._model, **self._config)
+            with self._cond:
+                self._cond.wait_for(lambda: old in self._free)
+                self._free.remove(old)
+                self._all.remove(old)
+                del self._uses[id(old)]
+                self._free.append(new)
+                self._all.append(new)
+                self._uses[id(new)] = 0
+                self._cond.notify_all()
+
+
+class JobQueue:
+    def __init__(self, data_dir, retention=0):
+        self._spool = os.path.join(data_dir, 'jobs')
+        self._path = os.path.join(data_dir, 'jobs.db')
+        self._retention = retention * 3600
+        self._pruned = 0
+        self._wakeup = threading.Event()
+        os.makedirs(self._spool, exist_ok=True)
+        # Uploads interrupted by a restart
+        for entry in os.scandir(self._spool):
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, state TEXT NOT NULL, callback TEXT, text TEXT, '
+                'created REAL NOT NULL, finished REAL)'
+            )
+            # Jobs interrupted by a restart go back to the queue, their audio is still in the spool
+            db.execute('UPDATE jobs SET state = \'queued\' WHERE state = \'running\'')
+        self._prune()
+
+    def _connect(self):
+        return closing(sqlite3.connect(self._path, timeout=30, isolation_level=None))
+
+    def _audio(self, job_id):
+        return os.path.join(self._spool, '{}.wav'.format(job_id))
+
+    def put(self, fp, callback=None):
+        job_id = uuid.uuid4().hex
+        tmp = self._audio(job_id) + '.tmp'
+        try:
+            with open(tmp, 'wb') as fd:
+                shutil.copyfileobj(fp, fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+        except Exception:
+            os.remove(tmp)
+            raise
+        if not os.path.getsize(tmp):
+            os.remove(tmp)
+            return None
+        os.replace(tmp, self._audio(job_id))
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO jobs (id, state, callback, created) VALUES (?, \'queued\', ?, ?)',
+                (job_id, callback, time.time())
+            )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as db:
+            row = db.execute('SELECT state, text FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else {'id': job_id, 'state': row[0], 'text': row[1]}
+
+    def _prune(self):
+        # At most once an hour, finished jobs have no audio in the spool
+        now = time.time()
+        if not self._retention or now - self._pruned < 3600:
+            return
+        self._pruned = now
+        with self._connect() as db:
+            db.execute(
+                'DELETE FROM jobs WHERE state IN (\'done\', \'failed\') AND finished < ?',
+                (now - self._retention,)
+            )
+
+    def take(self, timeout=5):
+        self._prune()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT id, callback FROM jobs WHERE state = \'queued\' ORDER BY created LIMIT 1'
+            ).fetchone()
+            if row is not None:
+                db.execute('UPDATE jobs SET state = \'running\' WHERE id = ?', (row[0],))
+            db.execute('COMMIT')
+        if row is not None:
+            return row[0], self._audio(row[0]), row[1]
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return None
+
+    def finish(self, job_id, state, text):
+        with self._connect() as db:
+            db.execute(
+                'UPDATE jobs SET state = ?, text = ?, finished = ? WHERE id = ?',
+                (state, text, time.time(), job_id)
+            )
+        try:
+            os.remove(self._audio(job_id))
+        except FileNotFoundError:
+            pass
+
+
+class TeeReader:
+    def __init__(self, fp):
+        self._fp = fp
+        self.data = bytearray()
+
+    def readinto(self, buf):
+        size = self._fp.readinto(buf)
+        if size:
+            self.data += memoryview(buf)[:size]
+        return size
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self.data += data
+        return data
+
+
+class MappedReader:
+    def __init__(self, mm):
+        self._mm = mm
+        self._view = memoryview(mm)
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+
+    def readinto(self, buf):
+        size = min(len(buf), len(self._view) - self._pos)
+        buf[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def getbuffer(self):
+        return self._view
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos):
+        self._pos = pos
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mm.close()
+        except BufferError:
+            # Still exported by a slice, the map is closed when it is collected
+            pass
+
+
+class LocalInputError(Exception):
+    pass
+
+
+class WavError(Exception):
+    pass
+
+
+class Capture:
+    SKIP_HEADERS = ('authorization', 'cookie')
+
+    def __init__(self, path, rate, max_size):
+        self._path = path
+        self._rate = rate
+        self._max_size = max_size * 1024 * 1024
+        if self._rate > 0:
+            os.makedirs(self._path, exist_ok=True)
+
+    def sample(self):
+        return self._rate > 0 and random.random() < self._rate
+
+    def save(self, data, headers, args, started, elapsed, text):
+        name = '{:.6f}-{}'.format(started, uuid.uuid4().hex[:8])
+        with open(os.path.join(self._path, name + '.wav'), 'wb') as fd:
+            fd.write(data)
+        meta = {
+            'time': started,
+            'elapsed': elapsed,
+            'headers': {key: val for key, val in headers.items() if key.lower() not in self.SKIP_HEADERS},
+            # Local input is replaced by the captured audio on replay
+            'args': {key: val for key, val in args.items() if key not in ('path', 'shm')},
+            'text': text,
+        }
+        with open(os.path.join(self._path, name + '.json'), 'w') as fd:
+            json.dump(meta, fd, ensure_ascii=False)
+        self._rotate()
+
+    def _rotate(self):
+        files = sorted(os.scandir(self._path), key=lambda x: x.name)
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total <= self._max_size:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+def load_model():
     main_dir = os.path.join('/opt', 'zero_ru_cont_8k_v3')
     config = {
         'hmm': os.path.join(main_dir, 'zero_ru.cd_ptm_4000'),
         'lm': os.path.join(main_dir, 'ru.lm'),
         'dict': os.path.join(main_dir, 'ru.dic'),
     }
+    # Model can be changed without rebuilding the image, it is read at start and on SIGHUP only
+    model = os.path.join(DATA_DIR, 'model.json')
+    if os.path.isfile(model):
+        with open(model) as fd:
+            config.update(json.load(fd))
+    return config
+
+
+def ps_init(model, **extra):
+    config = dict(model)
+    config.update(extra)
     return PocketSphinx(**config)
 
 
-ps = ps_init()
+def read_exact(fp, size):
+    data = b''
+    while len(data) < size:
+        chunk = fp.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_wav_header(fp):
+    # Returns channel count and bytes consumed if the data is not a wav (raw PCM)
+    head = read_exact(fp, 12)
+    if len(head) < 12 or head[:4] != b'RIFF' or head[8:] != b'WAVE':
+        return 1, head
+    channels = 1
+    while True:
+        chunk = read_exact(fp, 8)
+        if len(chunk) < 8:
+            raise WavError('Wrong wav header')
+        name, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if name == b'data':
+            return channels, b''
+        body = read_exact(fp, size + size % 2)
+        if name == b'fmt ':
+            if len(body) < 16:
+                raise WavError('Wrong wav header')
+            audio_format, channels, _, _, _, width = struct.unpack('<HHIIHH', body[:16])
+            # WAVE_FORMAT_EXTENSIBLE keeps the real format in the first bytes of the subformat GUID
+            if audio_format == 0xFFFE and len(body) >= 26:
+                audio_format = struct.unpack('<H', body[24:26])[0]
+            if audio_format != 1:
+                raise WavError('Only PCM wav is supported')
+            if channels > 1 and width != 16:
+                raise WavError('Multichannel audio must be 16 bit')
+
+
+def merge_segments(segments, frate):
+    result = []
+    words = sorted(
+        (start, channel, word.split('(')[0])
+        for channel, items in enumerate(segments) for word, _, start, _ in items
+        if not word.startswith(('<', '['))
+    )
+    for start, channel, word in words:
+        if result and result[-1]['channel'] == channel:
+            result[-1]['text'] += ' ' + word
+        else:
+            result.append({'channel': channel, 'start': start / frate, 'text': word})
+    return result
+
+
+def decode_channels(fp, channels, merge=False, decoders_pool=None):
+    data = fp.getbuffer()[fp.tell():] if isinstance(fp, (BytesIO, MappedReader)) else memoryview(fp.read())
+    samples = data[:len(data) - len(data) % (2 * channels)].cast('h')
+    results = [None] * channels
+
+    def worker(decoder, first, step):
+        for channel in range(first, channels, step):
+            decoder.decode_channel(samples, channel, channels)
+            results[channel] = (decoder.hypothesis(), decoder.segments(detailed=True) if merge else None)
+
+    with (decoders_pool or pool).acquire(channels) as decoders, ThreadPoolExecutor(len(decoders)) as executor:
+        for future in [executor.submit(worker, decoder, idx, len(decoders)) for idx, decoder in enumerate(decoders)]:
+            future.result()
+        frate = decoders[0].get_config().get_int('-frate')
+    result = {'channels': [text for text, _ in results]}
+    if merge:
+        result['merged'] = merge_segments([items for _, items in results], frate)
+        result['text'] = ' '.join(item['text'] for item in result['merged'])
+    else:
+        result['text'] = ' '.join(text for text in result['channels'] if text)
+    return result
+
+
+def decode_passes(fp, merge=False, fast=False, decoders_pool=None):
+    # Yields the early hypothesis with 'final': False if asked and possible, then the final result
+    decoders_pool = decoders_pool or pool
+    channels, head = read_wav_header(fp)
+    if channels > 1:
+        yield decode_channels(fp, channels, merge, decoders_pool)
+        return
+    if fast and fast_pool is not None:
+        if not isinstance(fp, (BytesIO, MappedReader)):
+            fp = BytesIO(fp.read())
+        pos = fp.tell()
+        with fast_pool.acquire() as (decoder,):
+            text = decoder.decode_fp(fp=fp, head=head).hypothesis()
+        yield {'text': text, 'final': False}
+        fp.seek(pos)
+    with decoders_pool.acquire() as (decoder,):
+        text = decoder.decode_fp(fp=fp, head=head).hypothesis()
+    yield {'text': text}
+
+
+def send_callback(url, job):
+    data = json.dumps(job).encode()
+    try:
+        urlopen(Request(url, data=data, headers={'Content-Type': 'application/json'}), timeout=30).close()
+    except Exception as e:
+        print('Callback {} failed: {}'.format(url, e))
+
+
+def run_job(job_id, path, callback):
+    try:
+        with open(path, 'rb') as fp:
+            text, state = next(decode_passes(fp, decoders_pool=job_pool))['text'], 'done'
+    except Exception as e:
+        text, state = str(e), 'failed'
+    jobs.finish(job_id, state, text)
+    if callback:
+        send_callback(callback, {'id': job_id, 'state': state, 'text': text})
+
+
+def job_worker():
+    while not stopping.is_set():
+        try:
+            job = jobs.take()
+            if job is not None:
+                run_job(*job)
+        except Exception as e:
+            # Queue errors (e.g. database is locked) must not kill the worker
+            print('Job worker error: {}'.format(e))
+            time.sleep(1)
+
+
+def reload_decoders():
+    print('Reloading decoders...')
+    try:
+        model = load_model()
+    except (OSError, ValueError) as e:
+        print('Can\'t read model config, keep the current one: {}'.format(e))
+        return
+    for item in (pool, fast_pool, job_pool):
+        if item is None:
+            continue
+        try:
+            item.reload(model)
+        except Exception as e:
+            print('Can\'t load the new model, keep the current one: {}'.format(e))
+            return
+    print('Decoders reloaded')
+
+
+def on_reload(*_):
+    threading.Thread(target=reload_decoders, daemon=True).start()
+
+
+def on_shutdown(*_):
+    if stopping.is_set():
+        return
+    print('Stopping, waiting for in-flight requests...')
+    stopping.set()
+    # serve_forever finishes the current request before exiting
+    threading.Thread(target=server.shutdown, daemon=True).start()
+    killer = threading.Timer(DRAIN_TIMEOUT, os._exit, (1,))
+    killer.daemon = True
+    killer.start()
+
+
+stopping = threading.Event()
+startup_model = load_model()
+pool = DecoderPool(DECODERS, startup_model, RECYCLE_AFTER)
+fast_pool = DecoderPool(1, startup_model, RECYCLE_AFTER, **FAST_CONFIG) if FAST_PASS else None
+job_pool = DecoderPool(JOB_DECODERS, startup_model, RECYCLE_AFTER)
+jobs = JobQueue(DATA_DIR, JOB_RETENTION)
+capture = Capture(os.path.join(DATA_DIR, 'capture'), CAPTURE_RATE, CAPTURE_SIZE)
 app = Flask(__name__, static_url_path='')
 
 
+def open_local(path=None, shm=None):
+    if path is not None and not LOCAL_DIR:
+        raise LocalInputError('Local files are disabled')
+    if path is None and not LOCAL_SHM:
+        raise LocalInputError('Shared memory is disabled')
+    try:
+        if path is not None:
+            root = os.path.realpath(LOCAL_DIR)
+            full = os.path.realpath(os.path.join(root, path))
+            if os.path.commonpath((root, full)) != root:
+                raise LocalInputError('Path is outside of LOCAL_DIR')
+        else:
+            shm = shm.lstrip('/')
+            if not shm or '/' in shm or shm in ('.', '..'):
+                raise LocalInputError('Wrong shared memory name')
+            full = os.path.join('/dev/shm', shm)
+        # O_NONBLOCK so a FIFO can't block the server, only regular files are mapped
+        fd = os.open(full, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode):
+                raise LocalInputError('{} is not a regular file'.format(path or shm))
+            if not info.st_size:
+                return None
+            return MappedReader(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        raise LocalInputError('Can\'t open {}: {}'.format(path or shm, e.strerror))
+    except ValueError as e:
+        # e.g. embedded null byte
+        raise LocalInputError('Can\'t open {!r}: {}'.format(path or shm, e))
+
+
+def request_target():
+    if 'path' in request.args or 'shm' in request.args:
+        return open_local(request.args.get('path'), request.args.get('shm'))
+    elif request.headers.get('Transfer-Encoding') == 'chunked':
+        return request.stream
+    elif request.data:
+        return BytesIO(request.data)
+    return None
+
+
+def stream_passes(first, passes, target, headers, args, started):
+    result = first
+    for result in chain([first], passes):
+        result['code'] = 0
+        result['elapsed'] = time.time() - started
+        result.setdefault('final', True)
+        yield json.dumps(result) + '\n'
+    if isinstance(target, TeeReader):
+        capture.save(target.data, headers, args, started, result['elapsed'], result['text'])
+
+
+def recognize(target, started):
+    if target is None:
+        return json.jsonify({'text': 'No data', 'code': 1})
+    if capture.sample():
+        target = TeeReader(target)
+    fast = request.args.get('fast') == '1'
+    passes = decode_passes(target, merge=request.args.get('merge') == '1', fast=fast)
+    try:
+        result = next(passes)
+    except WavError as e:
+        return json.jsonify({'text': str(e), 'code': 5})
+    if fast:
+        stream = stream_passes(result, passes, target, dict(request.headers), request.args.to_dict(), started)
+        return Response(stream, mimetype='application/x-ndjson')
+    result['elapsed'] = time.time() - started
+    if isinstance(target, TeeReader):
+        capture.save(target.data, request.headers, request.args, started, result['elapsed'], result['text'])
+    result['code'] = 0
+    return json.jsonify(result)
+
+
 @app.route('/stt', methods=['GET', 'POST'])
 def say():
-    if request.method == 'POST':
-        target = None
-        if request.headers.get('Transfer-Encoding') == 'chunked':
-            target = request.stream
-        elif request.data:
-            target = BytesIO(request.data)
-
-        if target is None:
-            text = 'No data'
-            code = 1
-        else:
-            text = ps.decode_fp(fp=target).hypothesis()
-            code = 0
-    else:
-        text = 'What do you want? I accept only POST!'
-        code = 2
-    return json.jsonify({'text': text, 'code': code})
+    if request.method != 'POST':
+        return json.jsonify({'text': 'What do you want? I accept only POST!', 'code': 2})
+    # Server processing time, including reading the request body
+    started = time.time()
+    try:
+        target = request_target()
+    except LocalInputError as e:
+        return json.jsonify({'text': str(e), 'code': 6})
+    response = recognize(target, started)
+    if isinstance(target, MappedReader):
+        # Streamed responses still read the map, close it only when the response is done
+        response.call_on_close(target.close)
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def job_add():
+    try:
+        target = request_target()
+    except LocalInputError as e:
+        return json.jsonify({'text': str(e), 'code': 6})
+    job_id = None if target is None else jobs.put(target, request.args.get('callback'))
+    if isinstance(target, MappedReader):
+        target.close()
+    if job_id is None:
+        return json.jsonify({'text': 'No data', 'code': 1})
+    return json.jsonify({'id': job_id, 'state': 'queued', 'code': 0})
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_get(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return json.jsonify({'text': 'Job not found', 'code': 3})
+    job['code'] = 4 if job['state'] == 'failed' else 0
+    return json.jsonify(job)
 
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8085, threaded=False)
+    # One worker per job decoder, take() claims each job atomically
+    workers = [threading.Thread(target=job_worker, daemon=True) for _ in range(JOB_DECODERS)]
+    for worker in workers:
+        worker.start()
+    server = make_server('0.0.0.0', 8085, app, threaded=False)
+    signal.signal(signal.SIGTERM, on_shutdown)
+    signal.signal(signal.SIGINT, on_shutdown)
+    signal.signal(signal.SIGHUP, on_reload)
+    server.serve_forever()
+    # Refuse new connections while the job workers finish
+    server.server_close()
+    for worker in workers:
+        worker.join()
+    print('stop')
@@ -2,19 +2,31 @@
 
 echo "Setting trap PID $$"
 trap cleanup INT TERM
+trap reload HUP
+
+app_pid() {
+    pgrep 'python' -a | grep 'app.py' | awk '{print $1}'
+}
 
 cleanup() {
     echo 'stopping...'
-    APP="$(pgrep 'python' -a | grep 'app.py' | awk '{print $1}')"
-    kill -TERM "$APP"
+    kill -TERM "$(app_pid)"
     wait
     echo "stop"
     exit 0
 }
 
+reload() {
+    echo 'reloading...'
+    kill -HUP "$(app_pid)"
+}
+
 if [ -f /opt/app.py ]; then
     python3 /opt/app.py &
 fi
 
-wait
-exit 1
\ No newline at end of file
+# wait returns on every trapped signal, keep waiting while the app is alive
+while [ -n "$(app_pid)" ]; do
+    wait
+done
+exit 1
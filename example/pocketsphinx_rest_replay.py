@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+SERVER = 'http://127.0.0.1:8085'
+# Body is sent whole, the chunked framing of the original request is not preserved
+SEND_HEADERS = ('content-type',)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Replay captured /stt traffic and compare results')
+    parser.add_argument('archive', type=str, help='Capture directory (/opt/data/capture)')
+    parser.add_argument('-S', type=str, default=SERVER, metavar='[URL]',
+                        help='Server address (default: {})'.format(SERVER))
+    parser.add_argument('-X', type=float, default=1.0, metavar='[SPEED]',
+                        help='Pacing speedup, 0 - send without delays (default: 1.0)')
+    return parser.parse_args()
+
+
+def load_archive(path):
+    result = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json'):
+            continue
+        audio = os.path.join(path, name[:-5] + '.wav')
+        if not os.path.isfile(audio):
+            continue
+        with open(os.path.join(path, name), encoding='utf-8') as fd:
+            meta = json.load(fd)
+        meta['audio'] = audio
+        result.append(meta)
+    return result
+
+
+def stt(meta, url) -> dict:
+    with open(meta['audio'], 'rb') as fd:
+        data = fd.read()
+    headers = {key: val for key, val in meta['headers'].items() if key.lower() in SEND_HEADERS}
+    args = meta.get('args')
+    started = time.time()
+    request = Request('{}/stt{}'.format(url, '?' + urlencode(args) if args else ''), data=data, headers=headers)
+    try:
+        # With fast=1 the reply is one json per line, the last one is final
+        lines = urlopen(request).read().decode('utf-8').splitlines()
+        result = json.loads([line for line in lines if line.strip()][-1])
+    except Exception as e:
+        result = {'code': -1, 'text': 'Request failed: {}'.format(e)}
+    # Server processing time is compared with the captured one, round trip only if the server doesn't report it
+    result.setdefault('elapsed', time.time() - started)
+    return result
+
+
+def replay(records, url, speed):
+    results = [None] * len(records)
+
+    def worker(index):
+        results[index] = stt(records[index], url)
+
+    threads = []
+    start, first = time.time(), records[0]['time']
+    for index, meta in enumerate(records):
+        if speed > 0:
+            delay = (meta['time'] - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        thread = threading.Thread(target=worker, args=(index,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(records, results):
+    old_total = new_total = mismatch = 0
+    for meta, result in zip(records, results):
+        old_total += meta['elapsed']
+        new_total += result['elapsed']
+        if result['code'] or result['text'] != meta['text']:
+            mismatch += 1
+            print('{}: {:.2f}s -> {:.2f}s'.format(os.path.basename(meta['audio']), meta['elapsed'], result['elapsed']))
+            print('  - {}'.format(meta['text']))
+            print('  + {}'.format(result['text'] if not result['code'] else '[{code}]: {text}'.format(**result)))
+    count = len(records)
+    print('Requests: {}, transcript changes: {}'.format(count, mismatch))
+    print('Mean latency: {:.3f}s -> {:.3f}s'.format(old_total / count, new_total / count))
+    old_sorted = sorted(meta['elapsed'] for meta in records)
+    new_sorted = sorted(result['elapsed'] for result in results)
+    p95 = min(count - 1, int(count * 0.95))
+    print('p95 latency: {:.3f}s -> {:.3f}s'.format(old_sorted[p95], new_sorted[p95]))
+
+
+def main():
+    arg = cli()
+    records = load_archive(arg.archive)
+    if not records:
+        print('No captures in {}'.format(arg.archive))
+        exit(1)
+    report(records, replay(records, arg.S, arg.X))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,8 @@ CFG = {
     'dockerfile': os.path.join(ds.WORK_DIR, 'Dockerfile.{}'.format(AARCH)),
     'data_path': os.path.join(ds.DATA_PATH, NAME),
     'restart': 'always',
-    'p': {8085: 8085}
+    'p': {8085: 8085},
+    'v': {'data': '/opt/data'}
 }
 
 ds.DockerStarter(CFG)